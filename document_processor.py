@@ -5,73 +5,300 @@ This module handles loading documents from a directory and splitting them into c
 It supports PDF and text files.
 """
 
+import functools
+import hashlib
+import json
 import os
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, DirectoryLoader
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from langchain_community.document_loaders import PyPDFLoader, TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
 
+try:
+    # Optional Rust-backed splitter, much faster on large documents
+    from semantic_text_splitter import TextSplitter
+except ImportError:
+    TextSplitter = None
 
-def load_documents(directory_path):
+SUPPORTED_EXTENSIONS = (".pdf", ".txt")
+MANIFEST_FILE = "manifest.json"
+
+# Below this many files, starting worker processes (each re-importing the
+# program and its dependencies) costs more than it saves
+POOL_MIN_FILES = 4
+
+
+def _scan_files(directory_path):
     """
-    Load documents from a directory with various file types.
+    Recursively find supported files in a directory.
+    
+    Args:
+        directory_path (str): Path to the directory to scan
+        
+    Yields:
+        os.DirEntry: Entry for each supported file
+    """
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan_files(entry.path)
+            elif entry.is_file() and entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                yield entry
+
+
+def _hash_head(path, size=64 * 1024):
+    """
+    Hash the first bytes of a file.
+    
+    Args:
+        path (str): Path to the file
+        size (int): Number of bytes to hash
+        
+    Returns:
+        str: SHA-1 hex digest
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(size)).hexdigest()
+
+
+def load_manifest(persist_directory):
+    """
+    Load the manifest of already-ingested files for a vector store.
+    
+    Args:
+        persist_directory (str): Directory where the vector store is persisted
+        
+    Returns:
+        dict: {"settings": processing settings used for the stored chunks,
+            "files": mapping of file path to [mtime, size, sha1 of first 64KB]}
+    """
+    manifest_path = os.path.join(persist_directory, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return {"settings": None, "files": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(persist_directory, manifest):
+    """
+    Save the manifest of ingested files for a vector store.
+    
+    Args:
+        persist_directory (str): Directory where the vector store is persisted
+        manifest (dict): Manifest as returned by load_manifest()
+    """
+    os.makedirs(persist_directory, exist_ok=True)
+    with open(os.path.join(persist_directory, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def find_removed_files(directory_path, files):
+    """
+    Find files in a manifest that were deleted from a directory.
     
     Args:
         directory_path (str): Path to the directory containing documents
+        files (dict): Mapping of ingested file path to fingerprint
         
     Returns:
-        list: List of loaded Document objects
+        list: Paths under directory_path that no longer exist
+    """
+    root = os.path.abspath(directory_path)
+    return [
+        path for path in files
+        if os.path.commonpath([root, os.path.abspath(path)]) == root and not os.path.isfile(path)
+    ]
+
+
+def _load_one(path):
     """
-    # Create loaders for different file types
-    pdf_loader = DirectoryLoader(directory_path, glob="**/*.pdf", loader_cls=PyPDFLoader)
-    text_loader = DirectoryLoader(directory_path, glob="**/*.txt", loader_cls=TextLoader)
+    Load a single file with the loader matching its extension.
     
-    documents = []
-    # Load documents using appropriate loaders
+    Args:
+        path (str): Path to a PDF or text file
+        
+    Returns:
+        list: List of loaded Document objects
+    """
     try:
-        documents.extend(pdf_loader.load())
-        print(f"Loaded PDF documents")
+        if path.lower().endswith(".pdf"):
+            return PyPDFLoader(path).load()
+        return TextLoader(path).load()
     except Exception as e:
-        print(f"Error loading PDF files: {e}")
+        print(f"Error loading {path}: {e}")
+        return []
+
+
+def _select_changed(entries, manifest):
+    """
+    Pick the files that are new or changed since the last ingestion.
+    
+    Files are matched to manifest entries by real path. Files whose mtime
+    and size match the manifest are skipped without being read. Otherwise the first 64KB are hashed, so files that were only
+    touched are skipped too.
+    
+    Args:
+        entries (list): List of os.DirEntry objects
+        manifest (dict): Mapping of file path to fingerprint
+        
+    Returns:
+        dict: Mapping of changed file path to its new fingerprint
+    """
+    # Files ingested under another spelling of their path, e.g. relative
+    # instead of absolute, keep their key rather than being added again
+    keys = {os.path.realpath(key): key for key in manifest}
+    
+    changed = {}
+    for entry in entries:
+        path = os.path.normpath(entry.path)
+        if path not in manifest:
+            path = keys.get(os.path.realpath(path), path)
+        stat = entry.stat()
+        previous = manifest.get(path)
+        if previous is not None and previous[:2] == [stat.st_mtime, stat.st_size]:
+            continue
+        
+        fingerprint = [stat.st_mtime, stat.st_size, _hash_head(path)]
+        if previous is not None and previous[1:] == fingerprint[1:]:
+            manifest[path] = fingerprint
+            continue
+        changed[path] = fingerprint
+    return changed
+
+
+def _load_in_pool(paths):
+    """
+    Load files in parallel across all CPU cores.
     
+    Args:
+        paths (list): Paths of the files to load
+        
+    Returns:
+        list: One list of loaded Document objects per path
+    """
     try:
-        documents.extend(text_loader.load())
-        print(f"Loaded text documents")
-    except Exception as e:
-        print(f"Error loading text files: {e}")
+        with ProcessPoolExecutor(max_workers=min(len(paths), os.cpu_count() or 1)) as executor:
+            return list(executor.map(_load_one, paths))
+    except (OSError, BrokenProcessPool) as e:
+        print(f"Process pool unavailable ({e}), falling back to threaded loading")
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            return list(executor.map(_load_one, paths))
+
+
+def load_documents(directory_path, manifest=None):
+    """
+    Load documents from a directory with various file types.
+    
+    Batches of several files are parsed in parallel across all CPU cores.
+    If a manifest is given, only files that are new or changed since it was
+    written are loaded, and the manifest is updated with their fingerprints.
+    
+    Args:
+        directory_path (str): Path to the directory containing documents
+        manifest (dict): Optional mapping of already-ingested file paths to
+            fingerprints, the "files" part of load_manifest()
+        
+    Returns:
+        tuple: (list of loaded Document objects, list of paths of the files
+            that loaded, as used for their "source" metadata)
+    """
+    entries = list(_scan_files(directory_path))
+    
+    if manifest is None:
+        changed = {os.path.normpath(entry.path): None for entry in entries}
+    else:
+        changed = _select_changed(entries, manifest)
+        print(f"Skipping {len(entries) - len(changed)} unchanged files")
+    
+    paths = list(changed)
+    if not paths:
+        return [], []
+    
+    if len(paths) < POOL_MIN_FILES:
+        results = [_load_one(path) for path in paths]
+    else:
+        results = _load_in_pool(paths)
+    
+    documents = []
+    loaded_paths = []
+    for path, loaded in zip(paths, results):
+        if not loaded:
+            # Not remembered in the manifest, so failures are retried next time
+            continue
+        documents.extend(loaded)
+        loaded_paths.append(path)
+        if manifest is not None:
+            manifest[path] = changed[path]
     
-    return documents
+    print(f"Loaded {len(paths)} files")
+    
+    return documents, loaded_paths
 
 
-def split_documents(documents, chunk_size=1000, chunk_overlap=200):
+@functools.lru_cache(maxsize=8)
+def _get_splitter(chunk_size, chunk_overlap):
     """
-    Split documents into chunks for processing.
+    Get a text splitter for the given sizes, reusing one built earlier.
     
     Args:
-        documents (list): List of Document objects
         chunk_size (int): Size of each chunk in characters
         chunk_overlap (int): Overlap between chunks in characters
         
     Returns:
-        list: List of chunked Document objects with metadata
+        TextSplitter or RecursiveCharacterTextSplitter: The text splitter
     """
-    text_splitter = RecursiveCharacterTextSplitter(
+    # TextSplitter needs the overlap to be smaller than the minimum chunk
+    # size, which rules out overlaps of half the chunk size or more
+    if TextSplitter is not None and 2 * chunk_overlap < chunk_size:
+        return TextSplitter((chunk_size - chunk_overlap, chunk_size), overlap=chunk_overlap)
+    # Keep the default len() length function, tokenizer-based ones are far slower
+    return RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         separators=["\n\n", "\n", ".", " ", ""]
     )
+
+
+def split_documents(documents, chunk_size=1000, chunk_overlap=200):
+    """
+    Split documents into chunks for processing.
     
-    chunks = text_splitter.split_documents(documents)
+    Args:
+        documents (list): List of Document objects
+        chunk_size (int): Size of each chunk in characters
+        chunk_overlap (int): Overlap between chunks in characters
+        
+    Returns:
+        list: List of chunked Document objects with metadata
+    """
+    text_splitter = _get_splitter(chunk_size, chunk_overlap)
+    if not isinstance(text_splitter, RecursiveCharacterTextSplitter):
+        chunks = [
+            Document(page_content=text, metadata=dict(doc.metadata))
+            for doc in documents
+            for text in text_splitter.chunks(doc.page_content)
+        ]
+    else:
+        chunks = text_splitter.split_documents(documents)
     
-    # Add metadata about which document and chunk this is
+    # Add metadata about which document and chunk this is, computing each
+    # file name only once per source
+    file_names = {}
     for i, chunk in enumerate(chunks):
-        if "source" in chunk.metadata:
-            file_name = os.path.basename(chunk.metadata["source"])
-            chunk.metadata["file_name"] = file_name
-        chunk.metadata["chunk_id"] = i
+        source = chunk.metadata.get("source")
+        if source is None:
+            chunk.metadata = {**chunk.metadata, "chunk_id": i}
+            continue
+        file_name = file_names.get(source)
+        if file_name is None:
+            file_name = file_names[source] = os.path.basename(source)
+        chunk.metadata = {**chunk.metadata, "file_name": file_name, "chunk_id": i}
     
     return chunks
 
 
-def process_directory(directory_path, chunk_size=1000, chunk_overlap=200):
+def process_directory(directory_path, chunk_size=1000, chunk_overlap=200, manifest=None):
     """
     Process all documents in a directory.
     
@@ -79,15 +306,18 @@ def process_directory(directory_path, chunk_size=1000, chunk_overlap=200):
         directory_path (str): Path to the directory containing documents
         chunk_size (int): Size of each chunk in characters
         chunk_overlap (int): Overlap between chunks in characters
+        manifest (dict): Optional manifest of already-ingested files, only
+            new or changed files are processed
         
     Returns:
-        list: List of processed document chunks
+        tuple: (list of processed document chunks, list of paths of the files
+            that loaded, including any that produced no chunks)
     """
     print(f"Processing documents in {directory_path}...")
-    documents = load_documents(directory_path)
+    documents, loaded_paths = load_documents(directory_path, manifest)
     print(f"Loaded {len(documents)} documents")
     
     chunks = split_documents(documents, chunk_size, chunk_overlap)
     print(f"Created {len(chunks)} chunks")
     
-    return chunks
\ No newline at end of file
+    return chunks, loaded_paths
\ No newline at end of file
@@ -5,67 +5,569 @@ This module handles creating and storing embeddings for document chunks
 using HuggingFace embeddings and ChromaDB.
 """
 
+import functools
+import json
+import math
+import os
+import sqlite3
+import uuid
+import hnswlib
+import numpy as np
+import torch
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
+from langchain_chroma.vectorstores import maximal_marginal_relevance
+from chromadb.utils.batch_utils import create_batches
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+# Exported ONNX models live next to this module, not the working directory
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "minilm-onnx")
+ONNX_INT8_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "minilm-int8")
+
+EMBEDDING_DIM = 384
+HNSW_INDEX_FILE = "hnsw_index.bin"
+HNSW_DOCS_FILE = "hnsw_docs.sqlite3"
+CHROMA_DB_FILE = "chroma.sqlite3"
+
+# How many candidates per result to fetch from the index for MMR
+FETCH_FACTOR = 4
+MMR_LAMBDA = 0.5
+
+# Below this many chunks, compiling the embedding model costs more than it saves
+COMPILE_MIN_CHUNKS = 2000
+
+# Process-wide caches so the model and vector stores are only loaded once
+_EMB = None
+_STORES = {}
+_HNSW_STORES = {}
+
+
+class ONNXEmbeddings(Embeddings):
+    """
+    INT8-quantized MiniLM embeddings running on ONNX Runtime.
+    
+    Produces the same mean-pooled, L2-normalized vectors as the
+    sentence-transformers model, but is several times faster on CPU.
+    """
+
+    def __init__(self, model_dir=ONNX_INT8_DIR, batch_size=64, max_length=256):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name="model_quantized.onnx"
+        )
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def _encode(self, texts):
+        inputs = self.tokenizer(
+            texts,
+            padding="longest",
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np"
+        )
+        hidden = self.model(**inputs).last_hidden_state
+        
+        # Mean-pool over real tokens, then L2 normalize
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        
+        # Encode in length-sorted buckets so each batch pads to a similar
+        # length, then undo the permutation
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        vectors = np.empty((len(texts), self.model.config.hidden_size), dtype=np.float32)
+        for bucket in np.array_split(order, math.ceil(len(texts) / self.batch_size)):
+            vectors[bucket] = self._encode([texts[i] for i in bucket])
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self._encode([text])[0].tolist()
+
+
+def export_onnx_model():
+    """
+    Export MiniLM to ONNX and quantize it to INT8, if not done already.
+    
+    Returns:
+        str: Directory containing the quantized model
+    """
+    if os.path.isfile(os.path.join(ONNX_INT8_DIR, "model_quantized.onnx")):
+        return ONNX_INT8_DIR
+    
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+    
+    print("Exporting embedding model to ONNX (one-time)...")
+    ORTModelForFeatureExtraction.from_pretrained(MODEL_NAME, export=True).save_pretrained(ONNX_MODEL_DIR)
+    ORTQuantizer.from_pretrained(ONNX_MODEL_DIR).quantize(
+        save_dir=ONNX_INT8_DIR,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    )
+    AutoTokenizer.from_pretrained(MODEL_NAME).save_pretrained(ONNX_INT8_DIR)
+    
+    return ONNX_INT8_DIR
+
 
 def get_embeddings():
     """
-    Initialize the HuggingFace embedding model.
+    Initialize the embedding model.
+    
+    On a GPU (CUDA, or MPS on Apple Silicon) the HuggingFace model is used,
+    in FP16 on CUDA. On CPU the INT8 ONNX model is used when optimum is
+    installed, otherwise the HuggingFace model. The model is loaded on first
+    use and reused for the rest of the process.
     
     Returns:
-        HuggingFaceEmbeddings: Initialized embedding model
+        Embeddings: Initialized embedding model
     """
-    return HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    global _EMB
+    if _EMB is None:
+        cuda = torch.cuda.is_available()
+        if not cuda and not torch.backends.mps.is_available():
+            try:
+                _EMB = ONNXEmbeddings(export_onnx_model())
+            except ImportError:
+                pass
+            except Exception as e:
+                print(f"ONNX embedding model unavailable ({e}), using the HuggingFace model")
+        if _EMB is None:
+            # Without CUDA, leave the device unset so sentence-transformers
+            # picks MPS when it is available
+            model_kwargs = {
+                "model_kwargs": {
+                    "torch_dtype": torch.float16 if cuda else torch.float32,
+                    "attn_implementation": "sdpa"
+                }
+            }
+            if cuda:
+                model_kwargs["device"] = "cuda"
+            _EMB = HuggingFaceEmbeddings(
+                model_name=MODEL_NAME,
+                model_kwargs=model_kwargs,
+                encode_kwargs={"normalize_embeddings": True, "batch_size": 128, "convert_to_numpy": True}
+            )
+    return _EMB
 
 
-def store_documents(chunks, persist_directory="./chroma_db"):
+def compile_embeddings():
     """
-    Store document chunks in a ChromaDB vector store.
+    Compile the HuggingFace embedding model with torch.compile.
+    
+    Compiling takes a while, so this is meant for long-running work such as
+    interactive mode or processing at least COMPILE_MIN_CHUNKS chunks. The
+    compiled model is warmed up here so real batches don't pay for
+    compilation. Does nothing for the ONNX model, and keeps the uncompiled
+    model if compilation isn't supported.
+    """
+    embeddings = get_embeddings()
+    if not isinstance(embeddings, HuggingFaceEmbeddings):
+        return
+    
+    transformer = embeddings._client[0]
+    # Older torch has no compile, and compiled modules keep the original
+    # as _orig_mod
+    if not hasattr(torch, "compile") or hasattr(transformer.auto_model, "_orig_mod"):
+        return
+    
+    # Warm up with a full batch and a short, longer-sequence one so the
+    # shapes seen later don't trigger recompilation outside this fallback
+    batch_size = embeddings.encode_kwargs.get("batch_size", 32)
+    original = transformer.auto_model
+    try:
+        transformer.auto_model = torch.compile(original, dynamic=True)
+        with torch.inference_mode():
+            embeddings.embed_documents(["warmup"] * batch_size)
+            embeddings.embed_documents(["warmup " * 64] * 3)
+    except Exception as e:
+        print(f"torch.compile unavailable ({e}), using the uncompiled embedding model")
+        transformer.auto_model = original
+
+
+def get_vectorstore(persist_directory="./chroma_db"):
+    """
+    Get the ChromaDB vector store for a persist directory.
+    
+    The store is opened on first use and reused for the rest of the process.
+    
+    Args:
+        persist_directory (str): Directory where the vector store is persisted
+        
+    Returns:
+        Chroma: The vector store
+    """
+    if persist_directory not in _STORES:
+        # New stores search unit-length embeddings by inner product; existing
+        # stores keep the distance they were created with
+        exists = os.path.isfile(os.path.join(persist_directory, CHROMA_DB_FILE))
+        collection_metadata = None if exists else {"hnsw:space": "ip"}
+        _STORES[persist_directory] = Chroma(
+            persist_directory=persist_directory,
+            embedding_function=get_embeddings(),
+            collection_metadata=collection_metadata
+        )
+    return _STORES[persist_directory]
+
+
+class HNSWStore:
+    """
+    Vector store backed directly by hnswlib.
+    
+    Vectors live in an hnswlib index and chunk text and metadata in a
+    SQLite table keyed by the same integer label, both persisted in the
+    store's directory. Embeddings are unit length, so the index uses
+    inner product rather than cosine distance.
+    """
+
+    def __init__(self, persist_directory, dim=EMBEDDING_DIM):
+        os.makedirs(persist_directory, exist_ok=True)
+        self.index_path = os.path.join(persist_directory, HNSW_INDEX_FILE)
+        
+        self.index = hnswlib.Index(space="ip", dim=dim)
+        if os.path.isfile(self.index_path):
+            self.index.load_index(self.index_path)
+        else:
+            # Save the empty index right away so the directory is recognized
+            # as an hnswlib store from now on
+            self.index.init_index(max_elements=1, ef_construction=200, M=16)
+            self.index.save_index(self.index_path)
+        
+        self.db = sqlite3.connect(
+            os.path.join(persist_directory, HNSW_DOCS_FILE),
+            check_same_thread=False
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, text TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+
+    def add(self, texts, metadatas, embeddings):
+        start = self.index.get_current_count()
+        labels = np.arange(start, start + len(texts))
+        if start + len(texts) > self.index.get_max_elements():
+            self.index.resize_index(start + len(texts))
+        
+        self.index.add_items(np.asarray(embeddings, dtype=np.float32), labels)
+        self.db.executemany(
+            "INSERT INTO chunks (id, text, metadata) VALUES (?, ?, ?)",
+            zip(labels.tolist(), texts, (json.dumps(metadata) for metadata in metadatas))
+        )
+        self.db.commit()
+        self.index.save_index(self.index_path)
+
+    def delete_sources(self, sources):
+        placeholders = ", ".join("?" * len(sources))
+        labels = [
+            row[0]
+            for row in self.db.execute(
+                f"SELECT id FROM chunks WHERE json_extract(metadata, '$.source') IN ({placeholders})",
+                list(sources)
+            )
+        ]
+        for label in labels:
+            self.index.mark_deleted(label)
+        self.db.executemany("DELETE FROM chunks WHERE id = ?", ((label,) for label in labels))
+        self.db.commit()
+        self.index.save_index(self.index_path)
+
+    def count(self):
+        # The index still counts labels marked as deleted, the table doesn't
+        return self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def get(self, labels):
+        labels = [int(label) for label in labels]
+        placeholders = ", ".join("?" * len(labels))
+        rows = {
+            row[0]: row[1:]
+            for row in self.db.execute(
+                f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})", labels
+            )
+        }
+        return [
+            Document(page_content=rows[label][0], metadata=json.loads(rows[label][1]), id=str(label))
+            for label in labels
+        ]
+
+    def query(self, query_vector, k, include_vectors=False):
+        k = min(k, self.count())
+        if k == 0:
+            return [], np.empty((0, self.index.dim), dtype=np.float32)
+        
+        self.index.set_ef(max(64, k))
+        labels, _ = self.index.knn_query(np.asarray(query_vector, dtype=np.float32), k=k)
+        vectors = np.asarray(self.index.get_items(labels[0]), dtype=np.float32) if include_vectors else None
+        return self.get(labels[0]), vectors
+
+
+def get_hnsw_store(persist_directory="./chroma_db"):
+    """
+    Get the hnswlib vector store for a persist directory.
+    
+    The store is opened on first use and reused for the rest of the process.
+    
+    Args:
+        persist_directory (str): Directory where the vector store is persisted
+        
+    Returns:
+        HNSWStore: The vector store
+    """
+    if persist_directory not in _HNSW_STORES:
+        _HNSW_STORES[persist_directory] = HNSWStore(persist_directory)
+    return _HNSW_STORES[persist_directory]
+
+
+def is_hnsw_store(persist_directory):
+    """
+    Check whether a persist directory holds an hnswlib vector store.
+    
+    Args:
+        persist_directory (str): Directory where the vector store is persisted
+        
+    Returns:
+        bool: True if the directory holds an hnswlib index
+    """
+    return os.path.isfile(os.path.join(persist_directory, HNSW_INDEX_FILE))
+
+
+def clear_store(persist_directory="./chroma_db", backend="chroma"):
+    """
+    Remove every chunk from a persist directory, whichever backend holds them.
+    
+    Retrieval picks the backend from the files in the directory, so chunks
+    left behind by another backend would otherwise shadow the new store.
+    
+    Args:
+        persist_directory (str): Directory where the vector store is persisted
+        backend (str): Backend the directory will be filled with next
+    """
+    store = _HNSW_STORES.pop(persist_directory, None)
+    if store is not None:
+        store.db.close()
+    for file_name in (HNSW_INDEX_FILE, HNSW_DOCS_FILE):
+        path = os.path.join(persist_directory, file_name)
+        if os.path.isfile(path):
+            os.remove(path)
+    
+    if os.path.isfile(os.path.join(persist_directory, CHROMA_DB_FILE)):
+        get_vectorstore(persist_directory).delete_collection()
+        del _STORES[persist_directory]
+        if backend == "chroma":
+            # Recreate the collection like a brand-new store
+            _STORES[persist_directory] = Chroma(
+                persist_directory=persist_directory,
+                embedding_function=get_embeddings(),
+                collection_metadata={"hnsw:space": "ip"}
+            )
+
+
+def embed_texts(texts, embedding_function=None):
+    """
+    Embed a list of texts in batches.
+    
+    Both embedding backends group texts of similar length into the same
+    batch to minimize padding.
+    
+    Args:
+        texts (list): List of strings to embed
+        embedding_function (Embeddings): Model to use, defaults to get_embeddings()
+        
+    Returns:
+        list: List of embedding vectors in the same order as texts
+    """
+    if embedding_function is None:
+        embedding_function = get_embeddings()
+    
+    with torch.inference_mode():
+        return embedding_function.embed_documents(texts)
+
+
+def delete_sources(sources, persist_directory="./chroma_db"):
+    """
+    Delete all chunks of the given source files from a vector store.
+    
+    Args:
+        sources (list): Source file paths, as stored in chunk metadata
+        persist_directory (str): Directory where the vector store is persisted
+    """
+    if not sources:
+        return
+    if is_hnsw_store(persist_directory):
+        get_hnsw_store(persist_directory).delete_sources(sources)
+    else:
+        get_vectorstore(persist_directory)._collection.delete(where={"source": {"$in": list(sources)}})
+
+
+def store_documents(chunks, persist_directory="./chroma_db", backend="chroma"):
+    """
+    Store document chunks in a vector store.
+    
+    Any chunks already stored for the same source files are replaced.
     
     Args:
         chunks (list): List of document chunks to store
         persist_directory (str): Directory to persist the vector store
+        backend (str): "chroma" for ChromaDB or "hnsw" for a plain hnswlib index
         
     Returns:
-        Chroma: The created vector store
+        Chroma or HNSWStore: The vector store
     """
-    # Initialize embedding function
-    embedding_function = get_embeddings()
+    texts = [chunk.page_content for chunk in chunks]
+    metadatas = [chunk.metadata for chunk in chunks]
+    ids = [str(uuid.uuid4()) for _ in chunks]
+    sources = list({metadata["source"] for metadata in metadatas if "source" in metadata})
     
-    # Create a Chroma vector store
-    vectorstore = Chroma.from_documents(
-        documents=chunks,
-        embedding=embedding_function,
-        persist_directory=persist_directory
-    )
+    # Embed everything up front in explicit batches
+    embeddings = embed_texts(texts)
+    
+    # Inner-product search relies on unit-length embeddings
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1)
+    if not np.allclose(norms, 1.0, atol=1e-2):
+        raise ValueError("Embedding model returned vectors that are not L2-normalized")
+    vectors /= norms[:, None]
+    embeddings = vectors.tolist()
+    
+    if backend == "hnsw":
+        store = get_hnsw_store(persist_directory)
+        if sources:
+            store.delete_sources(sources)
+        store.add(texts, metadatas, embeddings)
+        print(f"Stored {len(chunks)} chunks in hnswlib index at {persist_directory}")
+        return store
+    
+    vectorstore = get_vectorstore(persist_directory)
+    
+    # Drop chunks from earlier versions of these files
+    if sources:
+        vectorstore._collection.delete(where={"source": {"$in": sources}})
+    
+    # Add the pre-computed vectors so Chroma doesn't re-embed them
+    for batch in create_batches(
+        api=vectorstore._client,
+        ids=ids,
+        metadatas=metadatas,
+        documents=texts,
+        embeddings=embeddings
+    ):
+        vectorstore._collection.upsert(
+            ids=batch[0],
+            embeddings=batch[1],
+            metadatas=batch[2],
+            documents=batch[3]
+        )
     
     print(f"Stored {len(chunks)} chunks in ChromaDB at {persist_directory}")
     
     return vectorstore
 
 
-def retrieve_documents(query, top_k=5, persist_directory="./chroma_db"):
+@functools.lru_cache(maxsize=1024)
+def embed_query_cached(text):
     """
-    Retrieve relevant documents for a query.
+    Embed a query string, caching the result for repeated queries.
     
     Args:
-        query (str): The query string
+        text (str): The query string
+        
+    Returns:
+        tuple: The query embedding vector
+    """
+    with torch.inference_mode():
+        return tuple(get_embeddings().embed_query(text))
+
+
+def _fetch_candidates(query_vector, fetch_k, persist_directory, include_vectors=False):
+    """
+    Fetch the nearest documents to a query embedding from a vector store.
+    
+    Args:
+        query_vector (list): The query embedding vector
+        fetch_k (int): Number of candidates to fetch
+        persist_directory (str): Directory where the vector store is persisted
+        include_vectors (bool): Also return the candidates' embeddings
+        
+    Returns:
+        tuple: (list of documents, array of their embeddings or None)
+    """
+    if is_hnsw_store(persist_directory):
+        return get_hnsw_store(persist_directory).query(query_vector, fetch_k, include_vectors)
+    
+    collection = get_vectorstore(persist_directory)._collection
+    fetch_k = min(fetch_k, collection.count())
+    if fetch_k == 0:
+        return [], np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    
+    include = ["documents", "metadatas"]
+    if include_vectors:
+        include.append("embeddings")
+    results = collection.query(
+        query_embeddings=[list(query_vector)],
+        n_results=fetch_k,
+        include=include
+    )
+    documents = [
+        Document(page_content=text, metadata=metadata or {}, id=doc_id)
+        for doc_id, text, metadata in zip(results["ids"][0], results["documents"][0], results["metadatas"][0])
+    ]
+    vectors = np.asarray(results["embeddings"][0], dtype=np.float32) if include_vectors else None
+    
+    return documents, vectors
+
+
+def retrieve_by_vector(query_vector, top_k=5, persist_directory="./chroma_db", search_type="mmr"):
+    """
+    Retrieve relevant documents for a pre-computed query embedding.
+    
+    With "mmr", extra candidates are fetched from the index and maximal
+    marginal relevance picks relevant but diverse chunks among them, so
+    near-duplicates don't crowd the context. With "similarity", the top_k
+    nearest chunks are returned in the index's order.
+    
+    Args:
+        query_vector (list): The query embedding vector
         top_k (int): Number of documents to retrieve
         persist_directory (str): Directory where the vector store is persisted
+        search_type (str): "mmr" or "similarity"
         
     Returns:
-        list: List of (document, score) tuples
+        list: List of Document objects
     """
-    # Initialize embedding function
-    embedding_function = get_embeddings()
+    if search_type != "mmr":
+        documents, _ = _fetch_candidates(query_vector, top_k, persist_directory)
+        return documents
     
-    # Load existing vector store
-    vectorstore = Chroma(
-        persist_directory=persist_directory,
-        embedding_function=embedding_function
+    documents, vectors = _fetch_candidates(
+        query_vector, top_k * FETCH_FACTOR, persist_directory, include_vectors=True
     )
+    if not documents:
+        return []
     
-    # Retrieve relevant documents
-    results = vectorstore.similarity_search_with_score(query, k=top_k)
+    order = maximal_marginal_relevance(
+        np.asarray(query_vector, dtype=np.float32), vectors, lambda_mult=MMR_LAMBDA, k=top_k
+    )
+    return [documents[i] for i in order]
+
+
+def retrieve_documents(query, top_k=5, persist_directory="./chroma_db", search_type="mmr"):
+    """
+    Retrieve relevant documents for a query.
     
-    return results
\ No newline at end of file
+    Args:
+        query (str): The query string
+        top_k (int): Number of documents to retrieve
+        persist_directory (str): Directory where the vector store is persisted
+        search_type (str): "mmr" or "similarity", see retrieve_by_vector()
+        
+    Returns:
+        list: List of Document objects
+    """
+    return retrieve_by_vector(embed_query_cached(query), top_k, persist_directory, search_type)
@@ -7,7 +7,9 @@ continuously querying the RAG system.
 
 import os
 import argparse
-from rag_query import rag_query
+from concurrent.futures import ThreadPoolExecutor
+from rag_query import rag_query, preload_model
+from embedding_storage import retrieve_documents, compile_embeddings
 
 
 def interactive_mode(model="llama3:8b", top_k=5, db_path="./chroma_db"):
@@ -24,19 +26,29 @@ def interactive_mode(model="llama3:8b", top_k=5, db_path="./chroma_db"):
     print(f"Database: {db_path}")
     print('Type "exit" to quit\n')
     
+    executor = ThreadPoolExecutor(max_workers=1)
+    
+    # Load the LLM in the background while the embedding model and vector
+    # store are loaded, so the first question doesn't pay the startup cost
+    executor.submit(preload_model, model)
+    compile_embeddings()
+    retrieve_documents("warmup", 1, db_path)
+    
     while True:
         query = input("\nQuestion: ")
         if query.lower() in ["exit", "quit", "q"]:
             break
         
-        print("\nThinking...")
-        result = rag_query(query, model, top_k)
-        
+        # Print the answer as it is generated
         print("\nAnswer:")
-        print(result["answer"])
+        result = rag_query(query, model, top_k, db_path,
+                           on_token=lambda token: print(token, end="", flush=True))
+        print()
         print("\nSources:")
         for i, source in enumerate(result["sources"]):
             print(f"[{i+1}] {os.path.basename(source)}")
+    
+    executor.shutdown(wait=False)
 
 
 if __name__ == "__main__":
@@ -7,8 +7,8 @@ and querying the system.
 
 import argparse
 import os
-from document_processor import process_directory
-from embedding_storage import store_documents
+from document_processor import process_directory, load_manifest, save_manifest, find_removed_files
+from embedding_storage import store_documents, delete_sources, clear_store, compile_embeddings, COMPILE_MIN_CHUNKS
 from rag_query import rag_query
 
 
@@ -25,6 +25,7 @@ def main():
     process_parser.add_argument('--chunk-size', type=int, default=1000, help='Chunk size')
     process_parser.add_argument('--chunk-overlap', type=int, default=200, help='Chunk overlap')
     process_parser.add_argument('--db-path', default='./chroma_db', help='ChromaDB storage path')
+    process_parser.add_argument('--backend', choices=['chroma', 'hnsw'], default='chroma', help='Vector store backend')
     
     # Query command
     query_parser = subparsers.add_parser('query', help='Query the RAG system')
@@ -41,12 +42,49 @@ def main():
             print(f"Error: Directory {args.directory} does not exist")
             return
         
-        # Process documents
-        chunks = process_directory(args.directory, args.chunk_size, args.chunk_overlap)
+        # Process only documents that are new or changed since the last run,
+        # unless the settings the stored chunks were made with have changed
+        settings = {
+            "chunk_size": args.chunk_size,
+            "chunk_overlap": args.chunk_overlap,
+            "backend": args.backend
+        }
+        manifest = load_manifest(args.db_path)
+        files = manifest["files"]
+        
+        # Start from an empty database so chunks made with other settings,
+        # or stored by another backend, don't linger next to the new ones
+        cleared = manifest["settings"] != settings
+        if cleared:
+            if files:
+                print("Processing settings changed, re-processing all documents")
+            clear_store(args.db_path, args.backend)
+            files.clear()
+        
+        removed = find_removed_files(args.directory, files)
+        for path in removed:
+            del files[path]
+        
+        ingested = set(files)
+        chunks, loaded = process_directory(args.directory, args.chunk_size, args.chunk_overlap, files)
+        
+        # Changed files may have produced no chunks at all (emptied, or
+        # image-only PDFs), so their old chunks are dropped here rather than
+        # only when new ones are stored
+        replaced = [path for path in loaded if path in ingested]
+        if removed or replaced:
+            delete_sources(removed + replaced, args.db_path)
+        if removed:
+            print(f"Removed {len(removed)} deleted files from the database")
         if chunks:
-            store_documents(chunks, args.db_path)
+            if len(chunks) >= COMPILE_MIN_CHUNKS:
+                compile_embeddings()
+            store_documents(chunks, args.db_path, args.backend)
+        
+        if chunks or removed or replaced or cleared:
+            save_manifest(args.db_path, {"settings": settings, "files": files})
         else:
-            print("No documents were processed.")
+            print("No new or changed documents were processed.")
     
     elif args.command == 'query':
         # Make sure the database exists
@@ -55,9 +93,10 @@ def main():
             return
         
         # Query the system
-        result = rag_query(args.query, args.model, args.top_k)
         print("\nAnswer:")
-        print(result["answer"])
+        result = rag_query(args.query, args.model, args.top_k, args.db_path,
+                           on_token=lambda token: print(token, end="", flush=True))
+        print()
         print("\nSources:")
         for i, source in enumerate(result["sources"]):
             print(f"[{i+1}] {os.path.basename(source)}")
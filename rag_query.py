@@ -5,38 +5,195 @@ This module implements the Retrieval-Augmented Generation query functionality
 by retrieving relevant documents and querying the Ollama API.
 """
 
+import hashlib
+import json
+import re
 import requests
 import os
-from embedding_storage import retrieve_documents
+from collections import OrderedDict
+from embedding_storage import embed_query_cached, retrieve_by_vector
 
+# Keep-alive session so repeated queries reuse the same connection to Ollama
+_SESSION = requests.Session()
+_SESSION.headers["Content-Type"] = "application/json"
 
-def query_ollama(prompt, model="llama3:8b"):
+# Maximum characters of each retrieved chunk to include in the prompt
+MAX_CONTEXT_CHARS = 800
+
+# Number of LLM responses and RAG results kept in memory for repeated questions
+CACHE_SIZE = 512
+
+_RESPONSE_CACHE = OrderedDict()
+_RESULT_CACHE = OrderedDict()
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_WORD = re.compile(r"\w{3,}")
+
+
+def _cache_get(cache, key):
+    """
+    Look up a key in an LRU cache, marking it as recently used.
+    """
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def _cache_put(cache, key, value):
+    """
+    Add a value to an LRU cache, evicting the least recently used entry.
+    """
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def _prompt_key(model, prompt):
+    """
+    Build the response cache key for a model and prompt.
+    """
+    return model, hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+
+def query_ollama(prompt, model="llama3:8b", on_token=None):
     """
     Query the Ollama API with a prompt.
     
+    The response is streamed, so tokens can be shown as they are generated.
+    Completed responses are cached, so repeating a prompt returns the cached
+    answer without calling Ollama.
+    
     Args:
         prompt (str): The prompt to send to the model
         model (str): The Ollama model to use
+        on_token (callable): Optional function called with each generated token
         
     Returns:
         str: The model's response
     """
-    response = requests.post(
+    key = _prompt_key(model, prompt)
+    cached = _cache_get(_RESPONSE_CACHE, key)
+    if cached is not None:
+        if on_token is not None:
+            on_token(cached)
+        return cached
+    
+    with _SESSION.post(
         'http://localhost:11434/api/generate',
         json={
             "model": model,
             "prompt": prompt,
-            "stream": False
-        }
-    )
+            "stream": True
+        },
+        stream=True,
+        timeout=(3.05, 600)
+    ) as response:
+        if response.status_code != 200:
+            error = f"Error: {response.text}"
+            if on_token is not None:
+                on_token(error)
+            return error
+        
+        parts = []
+        done = False
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            # Failures during generation arrive as error lines with HTTP 200
+            if "error" in chunk:
+                error = f"Error: {chunk['error']}"
+                if on_token is not None:
+                    on_token(error)
+                return error
+            token = chunk.get("response", "")
+            parts.append(token)
+            if on_token is not None:
+                on_token(token)
+            if chunk.get("done"):
+                done = True
+                break
+    
+    answer = "".join(parts)
+    if done:
+        _cache_put(_RESPONSE_CACHE, key, answer)
     
-    if response.status_code == 200:
-        return response.json()["response"]
-    else:
-        return f"Error: {response.text}"
+    return answer
 
 
-def rag_query(user_query, model="llama3:8b", top_k=5):
+def preload_model(model="llama3:8b"):
+    """
+    Ask Ollama to load a model into memory without generating anything.
+    
+    Returns immediately if the model is already loaded. Uses its own
+    connection rather than the shared session, so it can run on another
+    thread while a query is streaming.
+    
+    Args:
+        model (str): The Ollama model to load
+        
+    Returns:
+        bool: True if the model is loaded
+    """
+    try:
+        response = requests.post(
+            'http://localhost:11434/api/generate',
+            json={"model": model},
+            timeout=(3.05, 600)
+        )
+    except requests.RequestException:
+        return False
+    return response.status_code == 200
+
+
+def compress_content(text, query, max_chars=MAX_CONTEXT_CHARS):
+    """
+    Trim a chunk to the sentences most relevant to the query.
+    
+    The sentence mentioning the most query terms is kept, along with its
+    neighbours, until max_chars is reached.
+    
+    Args:
+        text (str): The chunk text
+        query (str): The user's question
+        max_chars (int): Maximum length of the returned text
+        
+    Returns:
+        str: The trimmed text
+    """
+    if len(text) <= max_chars:
+        return text
+    
+    sentences = _SENTENCE_END.split(text)
+    terms = {match.group().lower() for match in _WORD.finditer(query)}
+    scores = [
+        sum(1 for match in _WORD.finditer(sentence) if match.group().lower() in terms)
+        for sentence in sentences
+    ]
+    best = max(range(len(sentences)), key=scores.__getitem__)
+    
+    # Grow a window around the best sentence while it fits
+    start, end = best, best + 1
+    length = len(sentences[best])
+    while True:
+        grew = False
+        for i in (end, start - 1):
+            if 0 <= i < len(sentences) and length + len(sentences[i]) + 1 <= max_chars:
+                length += len(sentences[i]) + 1
+                if i == end:
+                    end += 1
+                else:
+                    start -= 1
+                grew = True
+        if not grew:
+            break
+    
+    return " ".join(sentences[start:end])[:max_chars]
+
+
+def rag_query(user_query, model="llama3:8b", top_k=5, db_path="./chroma_db", on_token=None):
     """
     Perform a RAG query using the retrieved documents and Ollama.
     
@@ -44,29 +201,46 @@ def rag_query(user_query, model="llama3:8b", top_k=5):
         user_query (str): The user's question
         model (str): The Ollama model to use
         top_k (int): Number of documents to retrieve
+        db_path (str): Path to the ChromaDB directory
+        on_token (callable): Optional function called with each generated token
         
     Returns:
         dict: Dictionary containing answer and sources
     """
-    # Retrieve relevant documents
-    relevant_docs = retrieve_documents(user_query, top_k)
+    # Repeated questions are answered from the cache for this session
+    result_key = (user_query, model, top_k, db_path)
+    cached = _cache_get(_RESULT_CACHE, result_key)
+    if cached is not None:
+        if on_token is not None:
+            on_token(cached["answer"])
+        return dict(cached, sources=list(cached["sources"]))
+    
+    # Embed the query once and retrieve relevant documents with the vector
+    query_vector = embed_query_cached(user_query)
+    relevant_docs = retrieve_by_vector(query_vector, top_k, db_path)
     
-    # Prepare context from retrieved documents
+    # Prepare context and sources from retrieved documents in one pass,
+    # skipping duplicate chunks and trimming each one to the part relevant
+    # to the question. Sources are numbered in retrieval order.
     context_parts = []
-    sources = []
+    source_numbers = {}
+    seen_contents = set()
     
-    for doc, score in relevant_docs:
-        context_parts.append(f"Document: {doc.metadata.get('file_name', 'Unknown')}\nContent: {doc.page_content}")
-        if "source" in doc.metadata:
-            source = doc.metadata["source"]
-            sources.append(source)
+    for doc in relevant_docs:
+        if doc.page_content in seen_contents:
+            continue
+        seen_contents.add(doc.page_content)
+        content = compress_content(doc.page_content, user_query)
+        context_parts.append(f"Document: {doc.metadata.get('file_name', 'Unknown')}\nContent: {content}")
+        source = doc.metadata.get("source")
+        if source and source not in source_numbers:
+            source_numbers[source] = len(source_numbers) + 1
     
     context = "\n\n".join(context_parts)
     
     # Format sources for citation
-    formatted_sources = []
-    for i, source in enumerate(set(sources)):
-        formatted_sources.append(f"[{i+1}] {os.path.basename(source)}")
+    sources = list(source_numbers)
+    formatted_sources = [f"[{i}] {os.path.basename(source)}" for source, i in source_numbers.items()]
     
     # Create prompt with context
     prompt = f"""You are an educational assistant that answers questions based on course materials.
@@ -85,9 +259,15 @@ ANSWER:
 """
     
     # Query the LLM
-    answer = query_ollama(prompt, model)
+    answer = query_ollama(prompt, model, on_token)
     
-    return {
+    result = {
         "answer": answer,
-        "sources": list(set(sources))
-    }
\ No newline at end of file
+        "sources": sources
+    }
+    
+    # Only cache results whose generation completed
+    if _prompt_key(model, prompt) in _RESPONSE_CACHE:
+        _cache_put(_RESULT_CACHE, result_key, dict(result, sources=list(sources)))
+    
+    return result
\ No newline at end of file